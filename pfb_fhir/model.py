@@ -266,6 +266,15 @@ class Property(BaseModel):
     """The value."""
     complete: bool = False
     """Have we discovered schema profiles"""
+    _root_id: Optional[str] = PrivateAttr(default=None)
+    """Id of the first leaf element, cached."""
+
+    @property
+    def root_id(self):
+        """Getter, the id of the profile element for the first key part."""
+        if self._root_id is None:
+            self._root_id = self.leaf_elements[0]['id']
+        return self._root_id
 
 
 class ObservableProperty(ObservableData):
@@ -1,9 +1,11 @@
 """package."""
 from collections import defaultdict
-from copy import copy, deepcopy
+from copy import copy
+from functools import lru_cache
 from typing import Any, Dict, List
 
 import logging
+import re
 
 from pydantic import BaseModel
 
@@ -12,6 +14,156 @@ from pfb_fhir.model import TransformerContext
 logger = logging.getLogger(__name__)
 
 
+def _array_property_names(flattened_key: str, index: str):
+    """Yield the names of properties followed by array index in flattened_key, i.e. 'given' for 'name.0.given.1', '1'."""
+    marker = f".{index}"
+    start = flattened_key.find(marker)
+    while start > 0:
+        end = start + len(marker)
+        if end == len(flattened_key) or flattened_key[end] == '.':
+            yield flattened_key[flattened_key.rfind('.', 0, start) + 1:start]
+        start = flattened_key.find(marker, end)
+
+
+@lru_cache(maxsize=1024)
+def _single_item_index(property_names: frozenset) -> re.Pattern:
+    """Compile a pattern matching the '.0' index following any of property_names, i.e. 'name.0' in 'name.0.given'."""
+    return re.compile(r'(?<![^.])(' + '|'.join(map(re.escape, sorted(property_names))) + r')\.0(?=\.|$)')
+
+
+def _group_by_root(context: TransformerContext) -> Dict[str, list]:
+    """Gather flattened properties to original key."""
+    simplified_properties = defaultdict(list)
+    for property_ in context.properties.values():
+        simplified_properties[property_.root_id].append(property_)
+    return simplified_properties
+
+
+# the rewrites below depend only on the keys of a root group, not on values,
+# resources of the same shape share them, so they are planned once per distinct key tuple
+
+@lru_cache(maxsize=4096)
+def _single_item_keys(flattened_keys: tuple) -> tuple:
+    """Plan the keys of a group with single item list indices removed."""
+    # repeat until nothing is rewritten to get embedded single item lists
+    iteration = 0
+    while True:
+        logger.debug(f"iterate {iteration}")
+        # properties with a second item, i.e. 'given' for 'name.0.given.1'
+        multi_item_property_names = {
+            property_name for flattened_key in flattened_keys if '.1' in flattened_key
+            for property_name in _array_property_names(flattened_key, '1')
+        }
+        single_item_property_names = set()
+        for flattened_key in flattened_keys:
+            # most keys have no array index at all
+            if '.0' not in flattened_key:
+                continue
+            property_name = next(_array_property_names(flattened_key, '0'), None)
+            if property_name and property_name not in multi_item_property_names:
+                logger.debug(f"{property_name}.0  in {flattened_key} is a single item list")
+                single_item_property_names.add(property_name)
+        if not single_item_property_names:
+            break
+        # drop the index following any of the single item list properties in one substitution per key
+        single_item_index = _single_item_index(frozenset(single_item_property_names))
+        simplified_keys = tuple(single_item_index.sub(r'\1', flattened_key) for flattened_key in flattened_keys)
+        if simplified_keys == flattened_keys:
+            break
+        flattened_keys = simplified_keys
+        iteration += 1
+    return flattened_keys
+
+
+@lru_cache(maxsize=4096)
+def _extension_plan(flattened_keys: tuple) -> tuple:
+    """Plan (url, sub extension url, value) positions in a group, one per sub extension."""
+    # index the group in a single pass, lookups below are by exact key
+    positions = {}
+    # extension index -> sub extension indices, i.e. {0: {1}} for 'extension.0.extension.1.url'
+    extension_indices = defaultdict(set)
+    for position, flattened_key in enumerate(flattened_keys):
+        positions[flattened_key] = position
+        # only the leading 'extension.i.extension.j' parts are of interest
+        flattened_key_parts = flattened_key.split('.', 4)
+        if len(flattened_key_parts) < 2 or flattened_key_parts[0] != 'extension' or not flattened_key_parts[1].isdigit():
+            continue
+        sub_extension_indices = extension_indices[int(flattened_key_parts[1])]
+        if len(flattened_key_parts) > 3 and flattened_key_parts[2] == 'extension' and flattened_key_parts[3].isdigit():
+            sub_extension_indices.add(int(flattened_key_parts[3]))
+    plan = []
+    for extension_index in sorted(extension_indices):
+        url_position = positions[f"extension.{extension_index}.url"]
+        for sub_extension_index in sorted(extension_indices[extension_index]):
+            sub_extension_key = f"extension.{extension_index}.extension.{sub_extension_index}"
+            sub_extension_url_position = positions[f"{sub_extension_key}.url"]
+            value_position = positions.get(f"{sub_extension_key}.valueCoding.code")
+            if value_position is None:
+                value_position = positions.get(f"{sub_extension_key}.valueString")
+            plan.append((url_position, sub_extension_url_position, value_position))
+    return tuple(plan)
+
+
+@lru_cache(maxsize=4096)
+def _coding_plan(flattened_keys: tuple) -> tuple:
+    """Plan the positions of the first coding system, code and display in a group."""
+    system = code = display = None
+    for position, flattened_key in enumerate(flattened_keys):
+        if flattened_key.endswith('.coding.system'):
+            system = position if system is None else system
+        elif flattened_key.endswith('.coding.code'):
+            code = position if code is None else code
+        elif flattened_key.endswith('.coding.display'):
+            display = position if display is None else display
+    return system, code, display
+
+
+def _single_item_lists(properties: List) -> None:
+    """Simplify values with single item lists, in place."""
+    # values single item array
+    simplified_keys = _single_item_keys(tuple(p.flattened_key for p in properties))
+    for p, flattened_key in zip(properties, simplified_keys):
+        if flattened_key != p.flattened_key:
+            p.flattened_key = flattened_key
+
+
+def _extensions(properties: List) -> List:
+    """Simplify values with extensions, return the simplified properties of an extension group."""
+    simplified_extensions = []
+    for url_position, sub_extension_url_position, value_position in _extension_plan(tuple(p.flattened_key for p in properties)):
+        extension_name = properties[url_position].value.rpartition('/')[2]
+        sub_extension_name = properties[sub_extension_url_position].value.rpartition('/')[2]
+        sub_extension_value = properties[value_position] if value_position is not None else None
+        # logger.info(f"{extension_name}.{sub_extension_name} = {sub_extension_value.value}")
+        simplified_extension = sub_extension_value.copy(
+            update={'flattened_key': f"{extension_name}.{sub_extension_name}"})
+        simplified_extensions.append(simplified_extension)
+    return simplified_extensions
+
+
+def _codings(properties: List) -> None:
+    """Values with codings (just look at first level of dict for coding), in place."""
+    # first coding system, code and display in the group
+    system, code, display = (
+        properties[position] if position is not None else None
+        for position in _coding_plan(tuple(p.flattened_key for p in properties))
+    )
+    coded_keys = {p.flattened_key for p in (system, code, display) if p}
+    if not coded_keys:
+        return
+    simplified_coding_values = []
+    if system:
+        base_key = system.flattened_key[:-len('.coding.system')]
+        system_value = system.value.rpartition('/')[2]
+        if code:
+            # logger.info(f"{base_key}.{system_value} = {code.value}")
+            simplified_coding_values.append(code.copy(update={'flattened_key': f"{base_key}.{system_value}"}))
+        if display:
+            # logger.info(f"{base_key}.{system_value}.display = {display.value}")
+            simplified_coding_values.append(display.copy(update={'flattened_key': f"{base_key}.{system_value}.display"}))
+    properties[:] = [p for p in properties if p.flattened_key not in coded_keys] + simplified_coding_values
+
+
 class ContextSimplifier(object):
     """Simplify flattened properties."""
 
@@ -22,139 +174,18 @@ class ContextSimplifier(object):
         :rtype: object
         """
         assert context.properties
-        simplified_properties = ContextSimplifier._group_by_root(context)
-        simplified_properties = ContextSimplifier._extensions(simplified_properties)
-        simplified_properties = ContextSimplifier._single_item_lists(simplified_properties)
-        simplified_properties = ContextSimplifier._codings(simplified_properties)
+        simplified_properties = _group_by_root(context)
+        # skip steps that have nothing to simplify
+        has_codings = any('.coding.' in flattened_key for flattened_key in context.properties)
+        # a single traversal, each root group is simplified completely before moving on
+        for k, properties in list(simplified_properties.items()):
+            if k.endswith('extension'):
+                # simplified extensions replace the group, at the end
+                del simplified_properties[k]
+                properties = simplified_properties[k] = _extensions(properties)
+            _single_item_lists(properties)
+            if has_codings:
+                _codings(properties)
         # logger.info([p.flattened_key for p in context.properties.values()])
-        context.properties = {}
-        for k, properties in simplified_properties.items():
-            for p in properties:
-                context.properties[p.flattened_key] = p
+        context.properties = {p.flattened_key: p for properties in simplified_properties.values() for p in properties}
         return context
-
-    @staticmethod
-    def _group_by_root(context: TransformerContext) -> Dict[str, list]:
-        """Gather flattened properties to original key."""
-        simplified_properties = defaultdict(list)
-        for property_ in context.properties.values():
-            simplified_properties[property_.leaf_elements[0]['id']].append(property_)
-        return simplified_properties
-
-    @staticmethod
-    def _single_item_lists(simplified_properties: Dict[str, List]) -> Dict[str, List]:
-        """Simplify values with single item lists."""
-        # values single item array
-        # inspect 3x to get embedded single item lists
-        for i in range(3):
-            logger.debug(f"iterate {i}")
-            for k, properties in simplified_properties.items():
-                flattened_keys = [p.flattened_key for p in properties]
-                for flattened_key in flattened_keys:
-                    flattened_key_parts = flattened_key.split('.')
-                    array_index = -1
-                    if '0' in flattened_key_parts:
-                        array_index = flattened_key_parts.index('0')
-                    if array_index > 0:
-                        property_name = flattened_key_parts[array_index - 1]
-                        if not any([f"{property_name}.1" in k for k in flattened_keys]):
-                            logger.debug(f"{property_name}.0  in {flattened_key} is a single item list")
-                            for p in properties:
-                                # replace first occurrence of index in property name
-                                p.flattened_key = p.flattened_key.replace(f"{property_name}.0", property_name, 1)
-                simplified_properties[k] = properties
-
-        return simplified_properties
-
-    @staticmethod
-    def _extensions(simplified_properties: Dict[str, List]) -> Dict[str, List]:
-        """Simplify values with extensions."""
-        simplified_extensions = []
-        simplified_extensions_key = None
-        for k, properties in simplified_properties.items():
-            if not k.endswith('extension'):
-                continue
-            simplified_extensions_key = k
-            extension_index = 0
-            while True:
-                flattened_keys = [p.flattened_key for p in properties if
-                                  p.flattened_key.startswith(f"extension.{extension_index}")]
-                if len(flattened_keys) == 0:
-                    break
-
-                url_property = next(
-                    iter([p for p in properties if p.flattened_key == f"extension.{extension_index}.url"]))
-                extension_name = url_property.value.split('/')[-1]
-                sub_extension_index = 0
-                while True:
-                    sub_extension_flattened_keys = [p.flattened_key for p in properties if
-                                                    f"extension.{extension_index}.extension.{sub_extension_index}" in p.flattened_key]
-                    if len(sub_extension_flattened_keys) == 0:
-                        break
-                    sub_extension_url_property = next(
-                        iter([p for p in properties if
-                              p.flattened_key == f"extension.{extension_index}.extension.{sub_extension_index}.url"]))
-                    sub_extension_name = sub_extension_url_property.value.split('/')[-1]
-                    sub_extension_value = next(
-                        iter([p for p in properties if
-                              p.flattened_key == f"extension.{extension_index}.extension.{sub_extension_index}.valueCoding.code"]),
-                        None)
-                    if not sub_extension_value:
-                        sub_extension_value = next(
-                            iter([p for p in properties if
-                                  p.flattened_key == f"extension.{extension_index}.extension.{sub_extension_index}.valueString"]),
-                            None)
-
-                    # logger.info(f"{extension_name}.{sub_extension_name} = {sub_extension_value.value}")
-                    simplified_extension = deepcopy(sub_extension_value)
-                    simplified_extension.flattened_key = f"{extension_name}.{sub_extension_name}"
-                    simplified_extensions.append(simplified_extension)
-                    sub_extension_index += 1
-
-                extension_index += 1
-
-        if simplified_extensions_key:
-            del simplified_properties[simplified_extensions_key]
-            simplified_properties[simplified_extensions_key] = simplified_extensions
-
-        return simplified_properties
-
-    @staticmethod
-    def _codings(simplified_properties: Dict[str, List]) -> Dict[str, List]:
-        """Values with codings (just look at first level of dict for coding)."""
-        original_coded_values = defaultdict(list)
-        for k, properties in simplified_properties.items():
-            flattened_keys = [p.flattened_key for p in properties if 'coding' in p.flattened_key]
-            simplified_coding_values = []
-            if len(flattened_keys) > 0:
-                system = next(iter([k for k in flattened_keys if k.endswith('.coding.system')]), None)
-                code = next(iter([k for k in flattened_keys if k.endswith('.coding.code')]), None)
-                display = next(iter([k for k in flattened_keys if k.endswith('.coding.display')]), None)
-                if system:
-                    original_coded_values[k].append(system)
-                    system = next(iter([p for p in properties if p.flattened_key == system]), None)
-                if code:
-                    original_coded_values[k].append(code)
-                    code = next(iter([p for p in properties if p.flattened_key == code]), None)
-                if display:
-                    original_coded_values[k].append(display)
-                    display = next(iter([p for p in properties if p.flattened_key == display]), None)
-                if system and code:
-                    base_key = system.flattened_key.replace('.coding.system', '')
-                    system_value = system.value.split('/')[-1]
-                    # logger.info(f"{base_key}.{system_value} = {code.value}")
-                    simplified_coding = deepcopy(code)
-                    simplified_coding.flattened_key = f"{base_key}.{system_value}"
-                    simplified_coding_values.append(simplified_coding)
-                if system and display:
-                    base_key = system.flattened_key.replace('.coding.system', '')
-                    display_value = display.value
-                    # logger.info(f"{base_key}.{system_value}.display = {display_value}")
-                    simplified_coding = deepcopy(display)
-                    simplified_coding.flattened_key = f"{base_key}.{system_value}.display"
-                    simplified_coding_values.append(simplified_coding)
-            simplified_properties[k].extend(simplified_coding_values)
-        for k, original_coded_values in original_coded_values.items():
-            simplified_properties[k] = [p for p in simplified_properties[k] if
-                                        p.flattened_key not in original_coded_values]
-        return simplified_properties
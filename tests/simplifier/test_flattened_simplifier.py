@@ -6,11 +6,11 @@ from typing import Dict
 from pfb_fhir import initialize_model
 from pfb_fhir.cli import process_files
 from pfb_fhir.emitter import pfb, inspect_pfb
-from pfb_fhir.model import Property
+from pfb_fhir.model import Property, TransformerContext, Model
 
 import logging
 
-from pfb_fhir.simplifier import ContextSimplifier
+from pfb_fhir.simplifier import ContextSimplifier, _group_by_root, _extensions, _single_item_lists, _codings
 from tests import cleanup_emitter
 
 logger = logging.getLogger(__name__)
@@ -62,15 +62,16 @@ def test_flattened_synthea_patient_model(config_path, input_synthea_patient_path
             assert context
             assert isinstance(context.properties, dict)
             _to_tsv(context.properties)
-            simplified_properties = ContextSimplifier._group_by_root(context)
+            simplified_properties = _group_by_root(context)
             assert len(simplified_properties['Patient.extension']) == 26
             assert len(simplified_properties['Patient.address']) == 10
-            simplified_properties = ContextSimplifier._extensions(simplified_properties)
+            simplified_properties['Patient.extension'] = _extensions(simplified_properties['Patient.extension'])
             assert len(simplified_properties['Patient.extension']) == 4, "Should simplify root extensions"
             logger.warning("TODO - expected error.  Improve ContextSimplifier.")
             assert len(simplified_properties['Patient.address']) < 10, f"Should simplify property extensions {[p.flattened_key for p in simplified_properties['Patient.address'] if 'extension' in p.flattened_key]}"
-            simplified_properties = ContextSimplifier._single_item_lists(simplified_properties)
-            simplified_properties = ContextSimplifier._codings(simplified_properties)
+            for properties in simplified_properties.values():
+                _single_item_lists(properties)
+                _codings(properties)
 
             # only first record
             break
@@ -87,6 +88,22 @@ def test_flattened_synthea_patient_model(config_path, input_synthea_patient_path
         #     break
 
 
+def test_multiple_extension_groups():
+    """Each root extension group should be simplified on its own."""
+    context = TransformerContext(model=Model())
+    context.properties = {}
+    for root_id, url in [('Patient.extension', 'http://example.org/race'), ('Extension.extension', 'http://example.org/birthPlace')]:
+        for flattened_key, value in [('extension.0.url', url),
+                                     ('extension.0.extension.0.url', 'text'),
+                                     ('extension.0.extension.0.valueString', root_id)]:
+            context.properties[f"{root_id}:{flattened_key}"] = Property(
+                flattened_key=flattened_key, simple_key='extension', root_element={},
+                leaf_elements=[{'id': root_id}], value=value
+            )
+    context = ContextSimplifier.simplify(context)
+    assert {k: p.value for k, p in context.properties.items()} == {'race.text': 'Patient.extension', 'birthPlace.text': 'Extension.extension'}
+
+
 def test_flattened_ncpi_patient_emitter(config_path, input_ncpi_patient_paths, output_path, pfb_path):
     """Borrows fixtures from ncpi fhir resources."""
     model = initialize_model(config_path)